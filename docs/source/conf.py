@@ -62,9 +62,7 @@ html_static_path = ['_static']
 # -- Mock modules ------------------------------------------------------------
 
 autodoc_mock_imports = [
-    'numpy',
-    'pandas',
-    'scipy']
+    'numpy']
 
 
 # -- Other parameters --------------------------------------------------------
@@ -6,5 +6,11 @@ fNIRS signal processing simplified
 
 from .preprocessing import intensities_to_od_changes
 from .preprocessing import od_to_od_changes
+from .preprocessing import StreamingOD
 from .preprocessing import mbll
+from .preprocessing import mbll_plan
+from .preprocessing import mbll_apply
 from .processing import cbsi
+from .processing import cbsi_plan
+from .processing import cbsi_apply
+from .processing import StreamingCBSI
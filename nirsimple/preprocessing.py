@@ -3,11 +3,79 @@ The preprocessing module contains functions to preprocess fNIRS signals.
 """
 
 import warnings
+from collections import namedtuple
+from functools import lru_cache
 from os import path
 
 import numpy as np
-import pandas as pd
-from scipy import interpolate
+
+
+MbllPlan = namedtuple('MbllPlan', ['order', 'matrices', 'ch_names',
+                                   'ch_types'])
+MbllPlan.__doc__ = """
+Precomputed modified Beer-Lambert law for a fixed channel layout, as
+returned by mbll_plan.
+"""
+
+
+@lru_cache(maxsize=None)
+def _load_table(table):
+    """
+    Load a table of molar extinction coefficients, parsed once per table.
+
+    Parameters
+    ----------
+    table : string
+        Name of the table to load (see _extinctions).
+
+    Returns
+    -------
+    wl : array
+        numpy array of wavelengths (in nm).
+
+    hbo : array
+        numpy array of HbO molar extinction coefficients (in cm-1/M).
+
+    hbr : array
+        numpy array of HbR molar extinction coefficients (in cm-1/M).
+    """
+    ex_file = table + '.csv'
+    ex_path = path.join(path.dirname(__file__), 'tables', ex_file)
+    data = np.genfromtxt(ex_path, delimiter=',', names=True)
+    wl = data['lambda']
+    hbo = data['hbo']
+    hbr = data['hbr']
+    return wl, hbo, hbr
+
+
+@lru_cache(maxsize=None)
+def _interp_extinctions(wavelengths, table):
+    """
+    Interpolate molar extinction coefficients for a pair of wavelengths,
+    cached on (wavelengths, table).
+
+    Parameters
+    ----------
+    wavelengths : tuple of integers
+        The two wavelengths for which to get the molar extinction
+        coefficients (in nm).
+
+    table : string
+        Name of the table to use (see _extinctions).
+
+    Returns
+    -------
+    ex : array
+        Read-only numpy array of the extinction coefficients of shape (2, 2).
+    """
+    wl, hbo, hbr = _load_table(table)
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    if np.any(wavelengths < wl[0]) or np.any(wavelengths > wl[-1]):
+        raise Exception("no matching wavelength found")
+    ex = np.column_stack([np.interp(wavelengths, wl, hbo),
+                          np.interp(wavelengths, wl, hbr)])
+    ex.flags.writeable = False
+    return ex
 
 
 def _extinctions(wavelengths, table='wray', verbose=True):
@@ -54,21 +122,8 @@ def _extinctions(wavelengths, table='wray', verbose=True):
         citation = "S. Takatani and M.D. Graham compiled by S. Prahl"
     else:
         raise Exception("table unknown")
-    ex = []
     if len(wavelengths) == 2 and wavelengths[0] != wavelengths[1]:
-        ex_file = table + '.csv'
-        ex_path = path.join(path.dirname(__file__), 'tables', ex_file)
-        df = pd.read_csv(ex_path)
-        wl = df['lambda'].to_numpy()
-        hbo = df['hbo'].to_numpy()
-        hbr = df['hbr'].to_numpy()
-        interp_hbo = interpolate.interp1d(wl, hbo)
-        interp_hbr = interpolate.interp1d(wl, hbr)
-        for wavelength in wavelengths:
-            try:
-                ex.append([interp_hbo(wavelength), interp_hbr(wavelength)])
-            except ValueError:
-                raise Exception("no matching wavelength found")
+        ex = _interp_extinctions(tuple(wavelengths), table)
     else:
         raise Exception("wavelengths should be 2 different values")
 
@@ -80,11 +135,11 @@ def _extinctions(wavelengths, table='wray', verbose=True):
         print("(" + citation + ")")
         print("-----")
 
-    ex = np.array(ex)
     return ex
 
 
-def intensities_to_od_changes(intensities, refs=None):
+def intensities_to_od_changes(intensities, refs=None, dtype=None,
+                              validate=True):
     """
     Converts intensities into optical density changes. Changes are relative
     to the average intensity or a reference intensity for each channel.
@@ -106,6 +161,14 @@ def intensities_to_od_changes(intensities, refs=None):
         List of reference intensities to use instead of averages, length
         must be equal to the number of channels.
 
+    dtype : data-type
+        Floating point type used for the computation and the output (e.g.
+        np.float32 to halve memory use), defaults to the input type.
+
+    validate : boolean
+        Whether to warn about negative or zero values, which takes an extra
+        pass over the data. Set to False in performance critical pipelines.
+
     Returns
     -------
     delta_od : array
@@ -113,22 +176,92 @@ def intensities_to_od_changes(intensities, refs=None):
         intensities or a reference for each channel, of shape (channels, data
         points).
     """
+    # single buffer updated in place to avoid full-size temporaries
+    if dtype is None:
+        dtype = np.result_type(intensities, 1.0)
+    delta_od = np.absolute(intensities, dtype=dtype)
     if refs is None:
-        means = np.mean(np.absolute(intensities), axis=1)
-        means = np.expand_dims(means, axis=1)
-        delta_od = -np.log10(np.absolute(intensities)/means)
+        means = np.mean(delta_od, axis=1, keepdims=True)
+        np.divide(means, delta_od, out=delta_od)
     else:
         references = np.expand_dims(refs, axis=1)
-        delta_od = -np.log10(np.absolute(intensities)/references)
-        if np.any(references <= 0):
+        np.divide(references, delta_od, out=delta_od)
+        if validate and np.any(references <= 0):
             warnings.warn("some references are negative or equal to zero")
+    np.log10(delta_od, out=delta_od)  # -log10(I_t/I_ref) = log10(I_ref/I_t)
 
-    if np.any(intensities <= 0):
+    if validate and np.size(intensities) and np.min(intensities) <= 0:
         warnings.warn("some intensities are negative or equal to zero")
     return delta_od
 
 
-def od_to_od_changes(optical_densities, refs=None):
+class StreamingOD:
+    """
+    Conversion of streamed intensities into optical density changes (e.g.
+    for real-time processing). Changes are relative to the running average
+    intensity of each channel over all data points seen so far.
+
+    Parameters
+    ----------
+    validate : boolean
+        Whether to warn about negative or zero intensities, which takes an
+        extra pass over the data. Set to False in performance critical
+        pipelines.
+
+    Attributes
+    ----------
+    n : integer
+        Number of data points seen so far.
+
+    means : array
+        numpy array of the running average intensities, of shape (channels,
+        1).
+    """
+
+    def __init__(self, validate=True):
+        self.validate = validate
+        self.n = 0
+        self.means = None
+
+    def update(self, intensities):
+        """
+        Update the running average intensities with new data points and
+        convert them into optical density changes.
+
+        Parameters
+        ----------
+        intensities : array
+            numpy array of absolute intensities, must have the correct shape
+            (channels, new data points).
+
+        Returns
+        -------
+        delta_od : array
+            numpy array of optical density changes, relative to the running
+            average intensities, of shape (channels, new data points).
+        """
+        delta_od = np.absolute(intensities,
+                               dtype=np.result_type(intensities, 1.0))
+        k = delta_od.shape[-1]
+        if k == 0:  # nothing new, keep the running statistics untouched
+            return delta_od
+        means = np.mean(delta_od, axis=1, keepdims=True)
+        if self.n == 0:
+            self.means = means
+        else:
+            self.means = self.means + (means - self.means)*k/(self.n + k)
+        self.n += k
+
+        np.divide(self.means, delta_od, out=delta_od)
+        np.log10(delta_od, out=delta_od)
+
+        if (self.validate and np.size(intensities)
+                and np.min(intensities) <= 0):
+            warnings.warn("some intensities are negative or equal to zero")
+        return delta_od
+
+
+def od_to_od_changes(optical_densities, refs=None, validate=True):
     """
     Convert optical densities into optical density changes, relative to the
     average optical density or a reference optical density for each channel.
@@ -146,6 +279,10 @@ def od_to_od_changes(optical_densities, refs=None):
         List of reference optical densities to use instead of averages, length
         must be equal to the number of channels.
 
+    validate : boolean
+        Whether to warn about negative or zero values, which takes an extra
+        pass over the data. Set to False in performance critical pipelines.
+
     Returns
     -------
     delta_od : array
@@ -153,17 +290,19 @@ def od_to_od_changes(optical_densities, refs=None):
         densities or a reference for each channel, of shape (channels, data
         points).
     """
+    delta_od = np.absolute(optical_densities,
+                           dtype=np.result_type(optical_densities, 1.0))
     if refs is None:
-        means = np.mean(np.absolute(optical_densities), axis=1)
-        means = np.expand_dims(means, axis=1)
-        delta_od = np.absolute(optical_densities) - means
+        means = np.mean(delta_od, axis=1, keepdims=True)
+        np.subtract(delta_od, means, out=delta_od)
     else:
         references = np.expand_dims(refs, axis=1)
-        delta_od = np.absolute(optical_densities) - references
-        if np.any(references <= 0):
+        np.subtract(delta_od, references, out=delta_od)
+        if validate and np.any(references <= 0):
             warnings.warn("some references are negative or equal to zero")
 
-    if np.any(optical_densities <= 0):
+    if (validate and np.size(optical_densities)
+            and np.min(optical_densities) <= 0):
         warnings.warn("some optical densities are negative or equal to zero")
     return delta_od
 
@@ -203,7 +342,7 @@ def get_dpf(wavelength, age):
 
 
 def mbll(delta_od, ch_names, ch_wls, ch_dpfs, ch_distances, unit,
-         table='wray'):
+         table='wray', dtype=None):
     """
     Apply the modified Beer-Lambert law (from Delpy et al., 1988) to optical
     density changes in order to obtain concentration changes in oxygenated
@@ -251,6 +390,10 @@ def mbll(delta_od, ch_names, ch_wls, ch_dpfs, ch_distances, unit,
         'moaveni': data from M.K. Moaveni and J.M. Schmitt compiled by S. Prahl
         'takatani': data from S. Takatani and M.D. Graham compiled by S. Prahl
 
+    dtype : data-type
+        Floating point type used for the computation and the output (e.g.
+        np.float32 to halve memory use), defaults to float64.
+
     Returns
     -------
     delta_c : array
@@ -264,6 +407,52 @@ def mbll(delta_od, ch_names, ch_wls, ch_dpfs, ch_distances, unit,
         New list of channel types ('hbo' for oxygenated hemoglobin and 'hbr'
         for deoxygenated hemoglobin).
     """
+    plan = mbll_plan(ch_names, ch_wls, ch_dpfs, ch_distances, unit,
+                     table=table, dtype=dtype)
+    delta_c = mbll_apply(plan, delta_od)
+    delta_c = np.squeeze(delta_c)
+    return delta_c, list(plan.ch_names), list(plan.ch_types)
+
+
+def mbll_plan(ch_names, ch_wls, ch_dpfs, ch_distances, unit, table='wray',
+              dtype=None):
+    """
+    Precompute the modified Beer-Lambert law for a fixed channel layout, to
+    be applied repeatedly with mbll_apply (e.g. for real-time processing).
+
+    Parameters
+    ----------
+    ch_names : list of strings
+        List of channel names.
+
+    ch_wls : list of integers
+        List of channel wavelengths (in nm).
+
+    ch_dpfs : list of floats
+        List of channel differential pathlength factors (DPF) (or partial
+        pathlength factors (PPF)).
+
+    ch_distances : list of floats
+        List of channel source-detector distances.
+
+    unit : string
+        Unit for ch_distances ('cm' or 'mm').
+
+    table : string
+        Table to use as molar extinction coefficients (see mbll).
+
+    dtype : data-type
+        Floating point type used for the computation and the output (e.g.
+        np.float32 to halve memory use), defaults to float64.
+
+    Returns
+    -------
+    plan : MbllPlan
+        Named tuple holding the channel pairing (order), the matrices mapping
+        optical density changes to concentration changes for each pair
+        (matrices), and the new list of channel names (ch_names) and types
+        (ch_types).
+    """
     if unit == 'cm':
         pass
     elif unit == 'mm':
@@ -271,35 +460,62 @@ def mbll(delta_od, ch_names, ch_wls, ch_dpfs, ch_distances, unit,
         ch_distances = ch_distances.tolist()
     else:
         raise Exception("unit should be cm or mm")
-    delta_c = []
-    new_ch_names = []
-    new_ch_types = []
-    for name in np.unique(ch_names):
-        idx_1, idx_2 = [idx for idx, x in enumerate(ch_names) if x == name]
-
-        sub_delta_od = [delta_od[idx_1], delta_od[idx_2]]
-        sub_delta_od = np.swapaxes(sub_delta_od, 0, 1)  # timepoints first
-        sub_delta_od = np.expand_dims(sub_delta_od, axis=2)
-
-        ex = _extinctions([ch_wls[idx_1], ch_wls[idx_2]], table, verbose=False)
-        ex_inv = np.linalg.inv(ex)
-        ex_inv = np.tile(ex_inv, (len(sub_delta_od), 1, 1))
-
-        pl = [ch_dpfs[idx_1]*ch_distances[idx_1],
-              ch_dpfs[idx_2]*ch_distances[idx_2]]
-        pl = np.tile(np.array(pl), (len(sub_delta_od), 1))
-        pl = np.expand_dims(pl, axis=2)
-
-        sub_delta_c = np.matmul(ex_inv, sub_delta_od/pl)
-        sub_delta_c = np.swapaxes(sub_delta_c, 0, 1)  # channels first
-
-        delta_c.append(sub_delta_c[0])
-        delta_c.append(sub_delta_c[1])
-        new_ch_names.append(name)
-        new_ch_names.append(name)
-        new_ch_types.append('hbo')
-        new_ch_types.append('hbr')
-
-    delta_c = np.array(delta_c)
-    delta_c = np.squeeze(delta_c)
-    return delta_c, new_ch_names, new_ch_types
+    pair_names, inv, counts = np.unique(ch_names, return_inverse=True,
+                                        return_counts=True)
+    if np.any(counts != 2):
+        raise Exception("each channel name should have 2 wavelengths")
+    order = np.argsort(inv, kind='stable')
+    order = order.reshape(-1, 2)  # (pairs, 2) in channel name order
+
+    ch_wls = np.asarray(ch_wls)[order]
+    ex = np.stack([_extinctions(wls.tolist(), table, verbose=False)
+                   for wls in ch_wls])
+    # analytic 2x2 inverse: 1/(ad-bc) * [[d, -b], [-c, a]]
+    det = ex[:, 0, 0]*ex[:, 1, 1] - ex[:, 0, 1]*ex[:, 1, 0]
+    ex_inv = np.empty_like(ex)  # (pairs, 2, 2)
+    ex_inv[:, 0, 0] = ex[:, 1, 1]
+    ex_inv[:, 0, 1] = -ex[:, 0, 1]
+    ex_inv[:, 1, 0] = -ex[:, 1, 0]
+    ex_inv[:, 1, 1] = ex[:, 0, 0]
+    ex_inv /= det[:, None, None]
+
+    pl = (np.asarray(ch_dpfs, dtype=float)[order]
+          * np.asarray(ch_distances, dtype=float)[order])  # (pairs, 2)
+    # fold 1/(l*DPF) into the columns of the inverse: M = E^-1 . diag(1/pl)
+    ex_inv /= pl[:, None, :]
+    if dtype is not None:
+        ex_inv = ex_inv.astype(dtype)
+
+    new_ch_names = np.repeat(pair_names, 2).tolist()
+    new_ch_types = ['hbo', 'hbr'] * len(pair_names)
+    return MbllPlan(order, ex_inv, new_ch_names, new_ch_types)
+
+
+def mbll_apply(plan, delta_od):
+    """
+    Apply a precomputed modified Beer-Lambert law to optical density changes.
+
+    Parameters
+    ----------
+    plan : MbllPlan
+        Plan returned by mbll_plan for the channel layout of delta_od.
+
+    delta_od : array
+        numpy array of optical density changes, relative to average
+        intensities for each channel, of shape (channels, data points).
+
+    Returns
+    -------
+    delta_c : array
+        numpy array of hemoglobin concentration changes in [moles/liter] or [M]
+        for each channel of plan.ch_names and plan.ch_types, of shape
+        (channels, data points).
+    """
+    delta_od = np.asarray(delta_od, dtype=plan.matrices.dtype)
+    sub_delta_od = delta_od[plan.order]  # (pairs, 2, data points)
+    delta_c = np.empty((2*len(plan.order), delta_od.shape[-1]),
+                       dtype=delta_od.dtype)
+    # the (pairs, 2, data points) view writes HbO/HbR rows in place
+    np.matmul(plan.matrices, sub_delta_od,
+              out=delta_c.reshape(sub_delta_od.shape))
+    return delta_c
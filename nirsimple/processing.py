@@ -2,10 +2,20 @@
 The processing module contains functions to process fNIRS signals.
 """
 
+from collections import namedtuple
+
 import numpy as np
 
 
-def cbsi(delta_c, ch_names, ch_types):
+CbsiPlan = namedtuple('CbsiPlan', ['idx_hbo', 'idx_hbr', 'ch_names',
+                                   'ch_types'])
+CbsiPlan.__doc__ = """
+Precomputed channel pairing of correlation based signal improvement for a
+fixed channel layout, as returned by cbsi_plan.
+"""
+
+
+def cbsi(delta_c, ch_names, ch_types, dtype=None):
     """
     Apply correlation based signal improvement (from Cui at al., 2010) to
     hemoglobin concentration changes.
@@ -27,6 +37,10 @@ def cbsi(delta_c, ch_names, ch_types):
         List of channel types ('hbo' for oxygenated hemoglobin and 'hbr' for
         deoxygenated hemoglobin).
 
+    dtype : data-type
+        Floating point type used for the computation and the output (e.g.
+        np.float32 to halve memory use), defaults to the input type.
+
     Returns
     -------
     delta_c_0 : array
@@ -40,26 +54,196 @@ def cbsi(delta_c, ch_names, ch_types):
         New list of channel types ('hbo' for oxygenated hemoglobin and 'hbr'
         for deoxygenated hemoglobin).
     """
-    delta_c_0 = []
-    new_ch_names = []
-    new_ch_types = []
-    for name in np.unique(ch_names):
-        idx_hbo = [idx for idx, x in enumerate(ch_names)
-                   if x == name and ch_types[idx] == 'hbo']
-        idx_hbr = [idx for idx, x in enumerate(ch_names)
-                   if x == name and ch_types[idx] == 'hbr']
-
-        alpha = np.std(delta_c[idx_hbo]) / np.std(delta_c[idx_hbr])
-        delta_c_0_hbo = (delta_c[idx_hbo] - alpha*delta_c[idx_hbr]) / 2
-        delta_c_0_hbr = -delta_c_0_hbo / alpha
-
-        delta_c_0.append(delta_c_0_hbo)
-        delta_c_0.append(delta_c_0_hbr)
-        new_ch_names.append(name)
-        new_ch_names.append(name)
-        new_ch_types.append('hbo')
-        new_ch_types.append('hbr')
-
-    delta_c_0 = np.array(delta_c_0)
+    plan = cbsi_plan(ch_names, ch_types)
+    delta_c_0 = cbsi_apply(plan, delta_c, dtype=dtype)
     delta_c_0 = np.squeeze(delta_c_0)
-    return delta_c_0, new_ch_names, new_ch_types
+    return delta_c_0, list(plan.ch_names), list(plan.ch_types)
+
+
+def cbsi_plan(ch_names, ch_types):
+    """
+    Precompute the HbO/HbR channel pairing of correlation based signal
+    improvement for a fixed channel layout, to be applied repeatedly with
+    cbsi_apply (e.g. for real-time processing).
+
+    Parameters
+    ----------
+    ch_names : list of strings
+        List of channel names.
+
+    ch_types : list of strings
+        List of channel types ('hbo' for oxygenated hemoglobin and 'hbr' for
+        deoxygenated hemoglobin).
+
+    Returns
+    -------
+    plan : CbsiPlan
+        Named tuple holding the indices of the HbO (idx_hbo) and HbR (idx_hbr)
+        channel of each pair, and the new list of channel names (ch_names)
+        and types (ch_types).
+    """
+    names, inv = np.unique(ch_names, return_inverse=True)
+    is_hbo = np.asarray(ch_types) == 'hbo'
+    is_hbr = np.asarray(ch_types) == 'hbr'
+    if (np.any(np.bincount(inv[is_hbo], minlength=len(names)) != 1)
+            or np.any(np.bincount(inv[is_hbr], minlength=len(names)) != 1)):
+        raise Exception("each channel name should have one hbo and one hbr")
+    idx_hbos = np.empty(len(names), dtype=int)
+    idx_hbos[inv[is_hbo]] = np.flatnonzero(is_hbo)
+    idx_hbrs = np.empty(len(names), dtype=int)
+    idx_hbrs[inv[is_hbr]] = np.flatnonzero(is_hbr)
+
+    new_ch_names = np.repeat(names, 2).tolist()
+    new_ch_types = ['hbo', 'hbr'] * len(names)
+    return CbsiPlan(idx_hbos, idx_hbrs, new_ch_names, new_ch_types)
+
+
+def cbsi_apply(plan, delta_c, dtype=None):
+    """
+    Apply correlation based signal improvement to hemoglobin concentration
+    changes with a precomputed channel pairing.
+
+    Parameters
+    ----------
+    plan : CbsiPlan
+        Plan returned by cbsi_plan for the channel layout of delta_c.
+
+    delta_c : array
+        numpy array of hemoglobin concentration changes in [moles/liter] or [M]
+        for each channel, of shape (channels, data points).
+
+    dtype : data-type
+        Floating point type used for the computation and the output (e.g.
+        np.float32 to halve memory use), defaults to the input type.
+
+    Returns
+    -------
+    delta_c_0 : array
+        numpy array of corrected activation signals in [moles/liter] or [M] for
+        each channel of plan.ch_names and plan.ch_types, of shape (channels,
+        data points).
+    """
+    delta_c = np.asarray(delta_c, dtype=dtype)
+    hbo = delta_c[plan.idx_hbo]  # (channel pairs, data points)
+    hbr = delta_c[plan.idx_hbr]
+    alpha = (np.std(hbo, axis=1, keepdims=True)
+             / np.std(hbr, axis=1, keepdims=True))
+    return _correct(hbo, hbr, alpha)
+
+
+def _correct(hbo, hbr, alpha):
+    """
+    Compute the CBSI corrected signals from paired HbO and HbR signals.
+
+    Parameters
+    ----------
+    hbo : array
+        numpy array of HbO concentration changes, of shape (channel pairs,
+        data points).
+
+    hbr : array
+        numpy array of HbR concentration changes, of shape (channel pairs,
+        data points).
+
+    alpha : array
+        numpy array of the ratio of HbO to HbR standard deviations, of shape
+        (channel pairs, 1).
+
+    Returns
+    -------
+    delta_c_0 : array
+        numpy array of corrected activation signals with interleaved HbO and
+        HbR rows, of shape (channels, data points).
+    """
+    # write HbO/HbR rows straight into the interleaved output
+    delta_c_0 = np.empty((2*len(hbo), hbo.shape[-1]),
+                         dtype=np.result_type(hbo, alpha))
+    delta_c_0_hbo = delta_c_0[0::2]
+    delta_c_0_hbr = delta_c_0[1::2]
+    np.multiply(alpha, hbr, out=delta_c_0_hbo)
+    np.subtract(hbo, delta_c_0_hbo, out=delta_c_0_hbo)
+    delta_c_0_hbo /= 2
+    np.divide(delta_c_0_hbo, alpha, out=delta_c_0_hbr)
+    np.negative(delta_c_0_hbr, out=delta_c_0_hbr)
+    return delta_c_0
+
+
+class StreamingCBSI:
+    """
+    Correlation based signal improvement for streamed hemoglobin
+    concentration changes (e.g. for real-time processing). Alpha is computed
+    from running standard deviations over all data points seen so far,
+    updated with Welford's online algorithm.
+
+    Parameters
+    ----------
+    ch_names : list of strings
+        List of channel names.
+
+    ch_types : list of strings
+        List of channel types ('hbo' for oxygenated hemoglobin and 'hbr' for
+        deoxygenated hemoglobin).
+
+    Attributes
+    ----------
+    ch_names : list of strings
+        New list of channel names.
+
+    ch_types : list of strings
+        New list of channel types ('hbo' for oxygenated hemoglobin and 'hbr'
+        for deoxygenated hemoglobin).
+
+    n : integer
+        Number of data points seen so far.
+    """
+
+    def __init__(self, ch_names, ch_types):
+        self._plan = cbsi_plan(ch_names, ch_types)
+        self.ch_names = list(self._plan.ch_names)
+        self.ch_types = list(self._plan.ch_types)
+        self.n = 0
+        self._means = None
+        self._m2 = None
+
+    def update(self, delta_c):
+        """
+        Update the running statistics with new data points and apply
+        correlation based signal improvement to them.
+
+        Parameters
+        ----------
+        delta_c : array
+            numpy array of hemoglobin concentration changes in [moles/liter]
+            or [M] for each channel, of shape (channels, new data points).
+
+        Returns
+        -------
+        delta_c_0 : array
+            numpy array of corrected activation signals in [moles/liter] or
+            [M] for each channel of ch_names and ch_types, of shape (channels,
+            new data points).
+        """
+        delta_c = np.asarray(delta_c)
+        k = delta_c.shape[-1]
+        if k == 0:  # nothing new, keep the running statistics untouched
+            return np.empty((len(self.ch_names), 0),
+                            dtype=np.result_type(delta_c, 1.0))
+        means = np.mean(delta_c, axis=1, keepdims=True)
+        m2 = np.sum((delta_c - means)**2, axis=1, keepdims=True)
+        if self.n == 0:
+            self._means = means
+            self._m2 = m2
+        else:
+            # merge batch statistics (Chan et al. parallel variant)
+            n = self.n + k
+            delta = means - self._means
+            self._means = self._means + delta*k/n
+            self._m2 = self._m2 + m2 + delta**2*self.n*k/n
+        self.n += k
+
+        # the 1/n factors of both variances cancel out in the ratio
+        alpha = np.sqrt(self._m2[self._plan.idx_hbo]
+                        / self._m2[self._plan.idx_hbr])
+        hbo = delta_c[self._plan.idx_hbo]  # (channel pairs, data points)
+        hbr = delta_c[self._plan.idx_hbr]
+        return _correct(hbo, hbr, alpha)
@@ -16,9 +16,7 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     package_data={"nirsimple": ["tables/*.csv"]},
     install_requires=[
-        "numpy",
-        "pandas",
-        "scipy"
+        "numpy"
     ],
     classifiers=[
         "Programming Language :: Python :: 3",